@@ -1,20 +1,34 @@
-from fastapi import FastAPI, HTTPException, Cookie, Response, Request
-from supabase import create_client
+from fastapi import FastAPI, HTTPException, Cookie, Response, Request, BackgroundTasks, Depends, Query
+from supabase import acreate_client, AClient
 from fastapi.middleware.cors import CORSMiddleware
 from passlib.context import CryptContext
 from jose import jwt, JWTError
-from pydantic import BaseModel
-from datetime import datetime, timedelta
+from pydantic import BaseModel, ConfigDict, Field
+from datetime import datetime, timedelta, timezone
 from typing import Optional
-import json
 from fastapi import Body
 from datetime import date
-import requests
-from fastapi.responses import RedirectResponse
+import httpx
+import asyncio
+import uuid
+import asyncpg
+import orjson
+from tenacity import AsyncRetrying, stop_after_attempt, wait_random_exponential, retry_if_exception
+from postgrest.exceptions import APIError
+from postgrest.types import ReturnMethod
+from concurrent.futures import ProcessPoolExecutor
+from cachetools import TTLCache
+from fastapi.responses import RedirectResponse, ORJSONResponse
 import os
+import hashlib
+import time
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+# Supavisor transaction mode DSN (port 6543), used for the hot lookups:-
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")
+if not SUPABASE_DB_URL:
+    raise RuntimeError("SUPABASE_DB_URL is not set")
 JWT_SECRET = os.getenv("JWT_SECRET")
 RESEND_API_KEY = os.getenv("RESEND_API_KEY")
 if not RESEND_API_KEY:
@@ -22,53 +36,156 @@ if not RESEND_API_KEY:
 
 RESEND_FROM = "BookBack <onboarding@resend.dev>"
 
-supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Where verification links point, set it for staging / local runs:-
+BACKEND_BASE_URL = os.getenv("BACKEND_BASE_URL", "https://bookback-t83d.onrender.com").rstrip("/")
+VERIFY_URL_TEMPLATE = BACKEND_BASE_URL + "/verify-email?token={}"
+
+# Set on startup, the async client needs a running event loop:-
+supabase_client: Optional[AClient] = None
+
 # Setting up the app and adding the middleware:-
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["https://bookback.netlify.app"],
     allow_credentials=True,
     allow_headers=['*'],
-    allow_methods=['*']
+    allow_methods=['*'],
+    expose_headers=['ETag']  # the frontend reads it for If-None-Match
 )
 
+async def init_pg_connection(conn):
+    # Hand json/jsonb back as Python objects, like postgrest does
+    for typename in ("json", "jsonb"):
+        await conn.set_type_codec(
+            typename,
+            encoder=lambda value: orjson.dumps(value).decode(),
+            decoder=orjson.loads,
+            schema="pg_catalog"
+        )
+
+@app.on_event("startup")
+async def create_supabase_client():
+    global supabase_client
+    supabase_client = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+
+    # Swap postgrest's default session for one that keeps TLS connections
+    # alive, so every query doesn't pay for a fresh handshake. Bounded, so a
+    # burst queues for a socket instead of opening hundreds of them:-
+    postgrest = supabase_client.postgrest
+    default_session = postgrest.session
+    # JSON compresses well, ask for brotli (httpx[brotli]) or gzip:-
+    headers = httpx.Headers(default_session.headers)
+    headers["Accept-Encoding"] = "br, gzip"
+    app.state.http = httpx.AsyncClient(
+        base_url=default_session.base_url,
+        headers=headers,
+        http2=True,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=40, max_keepalive_connections=32, keepalive_expiry=300),
+        timeout=10
+    )
+    postgrest.session = app.state.http
+    await default_session.aclose()
+
+    app.state.supabase = supabase_client
+
+    # Direct Postgres for the hottest reads, skipping the Kong → PostgREST
+    # hop. statement_cache_size=0 because Supavisor's transaction mode can't
+    # keep named prepared statements; max_size stays well under the plan's
+    # connection limit.
+    app.state.pg = await asyncpg.create_pool(
+        dsn=SUPABASE_DB_URL,
+        min_size=2,
+        max_size=10,
+        statement_cache_size=0,
+        init=init_pg_connection
+    )
+
+    # bcrypt is pure CPU, keep it off the event loop (one process per core):-
+    app.state.bcrypt_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+    # One long lived Resend client, httpx reconnects if the socket drops:-
+    app.state.resend = httpx.AsyncClient(
+        base_url="https://api.resend.com",
+        headers={
+            "Authorization": f"Bearer {RESEND_API_KEY}",
+            "Content-Type": "application/json"
+        },
+        http2=True,
+        timeout=10
+    )
+
+@app.on_event("shutdown")
+async def close_supabase_client():
+    await app.state.http.aclose()
+    await app.state.resend.aclose()
+    await app.state.pg.close()
+    app.state.bcrypt_pool.shutdown()
+
 # IMPORTANT STUFF:-
 
 class UserSignup(BaseModel):
+    model_config = ConfigDict(extra="ignore")  # passwords are taken as typed
+
     username: str
     email: str
     password: str
 
 class UserLogin(BaseModel):
+    model_config = ConfigDict(extra="ignore")  # passwords are taken as typed
+
     email: str
     password: str
 
 class PatientDetails(BaseModel):
+    # coerce_numbers_to_str: older clients still send phone as a number
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True, coerce_numbers_to_str=True)
+
     name: str
     email: str
-    phone: int
+    phone: str
     next_visit: str
     reason: str
 
 class DeletePatient(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     patient_id: str
 
 class ClinicTimeSlots(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     ts_string: str
 
 class PatientAppointments(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     patient_id: str
 
 class DaySlotRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     token: str
     date: date
 
+class DaySlotsBulkRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
+    token: str
+    # The booking page offers a week, leave room for two
+    dates: list[date] = Field(min_length=1, max_length=14)
+
 class ModifySlots(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     token: str
     date: date
     slot: str
+
 class VerifyEmailRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     email: str
 
 
@@ -76,14 +193,7 @@ class VerifyEmailRequest(BaseModel):
 
 
 # Utilities:-
-def send_email_resend(to_email: str, subject: str, html: str):
-    url = "https://api.resend.com/emails"
-
-    headers = {
-        "Authorization": f"Bearer {RESEND_API_KEY}",
-        "Content-Type": "application/json"
-    }
-
+async def send_email_resend(to_email: str, subject: str, html: str):
     payload = {
         "from": RESEND_FROM,
         "to": [to_email],
@@ -91,12 +201,12 @@ def send_email_resend(to_email: str, subject: str, html: str):
         "html": html
     }
 
-    response = requests.post(url, headers=headers, json=payload)
+    response = await app.state.resend.post("/emails", json=payload)
 
     if response.status_code not in [200, 201]:
         raise Exception(f"Resend error: {response.text}")
 
-def send_verification_email(email: str, clinic_name: str, verify_link: str):
+async def send_verification_email(email: str, clinic_name: str, verify_link: str):
     subject = "Verify your email – BookBack"
 
     html = f"""
@@ -115,139 +225,246 @@ def send_verification_email(email: str, clinic_name: str, verify_link: str):
     <p>— BookBack</p>
     """
 
-    send_email_resend(
+    await send_email_resend(
         to_email=email,
         subject=subject,
         html=html
     )
 
+async def send_verification_task(email: str, clinic_name: str, verify_link: str, context: str):
+    # Runs after the response is sent. Email send must NEVER affect DB state,
+    # failures are only logged
+    try:
+        await send_verification_email(email, clinic_name, verify_link)
+    except Exception as e:
+        print(f"EMAIL FAILED ({context}):", e)
+
 
 algorithm = 'HS256'
-encryption_context = CryptContext(schemes=['bcrypt_sha256'], deprecated='auto')
+# Rounds pinned to ~100ms on our box. Hashes made with any other cost get
+# rehashed on the next successful login:-
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "11"))
+encryption_context = CryptContext(
+    schemes=['bcrypt_sha256'],
+    deprecated='auto',
+    bcrypt_sha256__default_rounds=BCRYPT_ROUNDS,
+    bcrypt_sha256__min_rounds=BCRYPT_ROUNDS,
+    bcrypt_sha256__max_rounds=BCRYPT_ROUNDS
+)
+encryption_context.hash("warmup")
 
 def hash_password(password: str):
     return encryption_context.hash(password)
 
 def verify_password(plain_password: str, hashed_password: str):
-    return encryption_context.verify(plain_password, hashed_password)
+    # Returns (valid, new_hash), new_hash is None unless the hash is outdated
+    return encryption_context.verify_and_update(plain_password, hashed_password)
+
+async def run_in_bcrypt_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.state.bcrypt_pool, func, *args)
 
 def create_token(data: dict):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(days=180)
+    expire = datetime.now(timezone.utc) + timedelta(days=180)
     to_encode.update({'exp': expire})
     return jwt.encode(to_encode, JWT_SECRET, algorithm=algorithm)
 
+# Verified token payloads, keyed by a hash of the raw token. The same
+# refresh token is presented over and over, no need to re-check the HMAC.
+JWT_CACHE = TTLCache(maxsize=100_000, ttl=300)
+
 def verify_token(token: str):
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    cached = JWT_CACHE.get(key)
+    if cached is not None:
+        exp, payload = cached
+        if exp > time.time():
+            return payload
+        JWT_CACHE.pop(key, None)
+        return None
+
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=algorithm)
-        return payload
     except JWTError:
         return None
 
+    JWT_CACHE[key] = (payload.get("exp", 0), payload)
+    return payload
+
 
 
 
 
 import secrets
-import string
 
 def generate_token(length: int = 32) -> str:
-    alphabet = string.ascii_letters + string.digits
-    return ''.join(secrets.choice(alphabet) for _ in range(length))
+    # One urandom read; base64 gives 4 url-safe chars per 3 bytes
+    return secrets.token_urlsafe(length * 3 // 4)
+
+
+# Retrying Supabase calls:-
+# PostgREST / Postgres error codes that are worth another go: PostgREST
+# can't reach or get a connection to the db, too many connections,
+# serialization failure, deadlock.
+# postgrest-py raises APIError for every non-2xx, gateway errors included:
+# a non-JSON 502/503/504 comes back with the int status as its code, the 429
+# from the rate limiter has no code at all, only its message.
+TRANSIENT_DB_CODES = {"PGRST000", "PGRST001", "PGRST002", "PGRST003", "53300", "40001", "40P01"}
+TRANSIENT_HTTP_CODES = {"429", "502", "503", "504"}
+
+def is_transient(e: BaseException) -> bool:
+    if isinstance(e, httpx.TransportError):
+        return True
+    if not isinstance(e, APIError):
+        return False
+    # str(): codes are strings from a JSON body, ints from an HTML one
+    if e.code in TRANSIENT_DB_CODES or str(e.code) in TRANSIENT_HTTP_CODES:
+        return True
+    return e.code is None and "rate limit" in (e.message or "").lower()
+
+async def execute(query):
+    # Every call is a read or an idempotent write (updates, upserts, inserts
+    # and rpcs keyed by a request_id), so any transient error is retried.
+    # Don't send a non-idempotent write through here.
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(4),
+        wait=wait_random_exponential(multiplier=0.1, max=2),
+        retry=retry_if_exception(is_transient),
+        reraise=True
+    ):
+        with attempt:
+            return await query.execute()
+
+
+# Clinic rows by email. Small and rarely changed, so keep them in process
+# for a minute. Pop the email after writing any of CLINIC_COLUMNS.
+# (Per worker only, move this to redis with SETEX if we run several.)
+CLINIC_COLUMNS = "id,clinic_name,email,is_active,email_verified"
+CLINIC_CACHE = TTLCache(maxsize=10_000, ttl=60)
+
+def cache_clinic(row: dict) -> dict:
+    clinic = {column: row[column] for column in CLINIC_COLUMNS.split(",")}
+    CLINIC_CACHE[clinic["email"]] = clinic
+    return clinic
+
+async def get_clinic_by_email(email: str) -> Optional[dict]:
+    clinic = CLINIC_CACHE.get(email)
+    if clinic is None:
+        row = await app.state.pg.fetchrow(
+            "SELECT id::text, clinic_name, email, is_active, email_verified FROM clinics WHERE email = $1",
+            email
+        )
+        if not row:
+            return None
+        clinic = cache_clinic(dict(row))
+    return clinic
+
+
+# Auth dependencies. FastAPI runs each once per request, even when a route
+# pulls in both. Keep them async: a sync dependency runs in the threadpool,
+# and JWT_CACHE / CLINIC_CACHE (TTLCache) aren't thread safe.
+async def current_email(refresh_token: str = Cookie(None)) -> str:
+    if not refresh_token:
+        raise HTTPException(status_code=401, detail="No refresh token")
+
+    payload = verify_token(refresh_token)
+    if not payload:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+
+    return payload.get("sub")
+
+async def current_clinic(email: str = Depends(current_email)) -> dict:
+    clinic = await get_clinic_by_email(email)
+    if not clinic:
+        raise HTTPException(status_code=401, detail="User not found")
+    return clinic
+
+
+# Page size for the list endpoints:-
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+# clinic_slots by email. Read on every booking flow, only written by
+# /save-clinic-slots, which pops the entry.
+# Entries are (slots, etag) so /get-clinic-slots can answer 304s from memory.
+SLOTS_CACHE = TTLCache(maxsize=10_000, ttl=300)
+
+def cache_slots(email: str, slots) -> tuple:
+    etag = '"' + hashlib.blake2b(orjson.dumps(slots), digest_size=16).hexdigest() + '"'
+    SLOTS_CACHE[email] = (slots, etag)
+    return slots, etag
 
 #===================================================================
 
 
 #==========================ALL ROUTES==============================#
 @app.post("/signup")
-def user_signup(user_details: UserSignup):
-    # 1️⃣ Check if email already exists
-    existing = (
-        supabase_client
-        .table("clinics")
-        .select("*")
-        .eq("email", user_details.email)
-        .execute()
-    )
-
-    # ================= EXISTING USER =================
-    if existing.data:
-        user = existing.data[0]
-
-        # Already verified → hard reject
-        if user["email_verified"]:
-            raise HTTPException(
-                status_code=400,
-                detail="Email already registered"
-            )
-
-        # Not verified → regenerate token
-        token = generate_token()
-
-        supabase_client.table("clinics").update({
-            "email_verify_token": token
-        }).eq("id", user["id"]).execute()
-
-        verify_link = f"https://bookback-t83d.onrender.com/verify-email?token={token}"
-
-        # Email is a SIDE EFFECT — never break flow
-        try:
-            send_verification_email(
-                user["email"],
-                user["clinic_name"],
-                verify_link
-                            )
-        except Exception as e:
-            print("EMAIL FAILED (resend):", e)
+async def user_signup(user_details: UserSignup, background_tasks: BackgroundTasks):
+    CLINIC_CACHE.pop(user_details.email, None)
 
-        return {
-            "signup": "pending",
-            "message": "Verification email sent (or resent)"
-        }
-
-    # ================= NEW USER =================
-    hashed_password = hash_password(user_details.password)
-    token = generate_token()
+    hashed_password = await run_in_bcrypt_pool(hash_password, user_details.password)
 
-    new_user = {
-        "email": user_details.email,
-        "clinic_name": user_details.username,
-        "password_hash": hashed_password,
-        "email_verified": False,
-        "email_verify_token": token
-    }
+    # New email → insert, unverified → regenerate token, verified → no row.
+    # One atomic round trip, the db makes the token and hands it back
+    # (sql/012_db_generated_verify_token.sql)
+    result = await execute(supabase_client.rpc("signup_or_resend", {
+        "p_email": user_details.email,
+        "p_hash": hashed_password,
+        "p_name": user_details.username
+    }))
 
-    inserted = supabase_client.table("clinics").insert(new_user).execute()
-    user = inserted.data[0]
+    # Already verified → hard reject
+    if not result.data:
+        raise HTTPException(
+            status_code=400,
+            detail="Email already registered"
+        )
 
-    print("INSERTED USER:", user)  # ← debug once, then remove
+    user = result.data[0]
 
-    verify_link = f"https://bookback-t83d.onrender.com/verify-email?token={token}"
+    verify_link = VERIFY_URL_TEMPLATE.format(user["email_verify_token"])
 
-    # Email send must NEVER affect DB state
-    try:
-        send_verification_email(
+    # ================= NEW USER =================
+    if user["created"]:
+        # Send after responding, signup only waits on the db
+        background_tasks.add_task(
+            send_verification_task,
             user["email"],
             user["clinic_name"],
-            verify_link
-            )
-    except Exception as e:
-        print("EMAIL FAILED (signup):", e)
+            verify_link,
+            "signup"
+        )
+
+        return {
+            "signup": "success",
+            "message": "Verification email sent"
+        }
+
+    # ================= EXISTING USER =================
+    # Email is a SIDE EFFECT — never break flow, send it after responding
+    background_tasks.add_task(
+        send_verification_task,
+        user["email"],
+        user["clinic_name"],
+        verify_link,
+        "resend"
+    )
 
     return {
-        "signup": "success",
-        "message": "Verification email sent"
+        "signup": "pending",
+        "message": "Verification email sent (or resent)"
     }
 
 
 @app.post('/login')
-def user_login(user_details: UserLogin, response: Response):
-    result = (
+async def user_login(user_details: UserLogin, response: Response):
+    result = await execute(
         supabase_client
         .table('clinics')
-        .select('*')
+        .select('id,clinic_name,password_hash')
         .eq('email', user_details.email)
-        .execute()
     )
 
     # Email not found
@@ -260,12 +477,19 @@ def user_login(user_details: UserLogin, response: Response):
     user = result.data[0]
 
     # Password incorrect
-    if not verify_password(user_details.password, user['password_hash']):
+    valid, new_hash = await run_in_bcrypt_pool(verify_password, user_details.password, user['password_hash'])
+    if not valid:
         raise HTTPException(
             status_code=401,
             detail="Invalid email or password"
         )
 
+    # Hash made with old settings → store one with the current cost
+    if new_hash:
+        await execute(supabase_client.table("clinics").update({
+            "password_hash": new_hash
+        }, returning=ReturnMethod.minimal).eq("id", user["id"]))
+
     refresh_token = create_token({'sub': user_details.email})
 
     response.set_cookie(
@@ -283,37 +507,41 @@ def user_login(user_details: UserLogin, response: Response):
     }
 
 @app.post("/refresh")
-def user_refresh(response: Response, refresh_token: str = Cookie(None)):
-    print("REFRESH TOKEN:", refresh_token)
-    if not refresh_token:
-        raise HTTPException(status_code=400, detail="No refresh token")
-
-    payload = verify_token(refresh_token)
-    if not payload:
-        raise HTTPException(status_code=400, detail="Invalid refresh token")
-
-    email = payload.get("sub")
-
-    result = (
-        supabase_client
-        .table("clinics")
-        .select("*")
-        .eq("email", email)
-        .execute()
-    )
-
-    if not result.data:
-        raise HTTPException(status_code=401, detail="User not found")
-
-    user = result.data[0]
-
+async def user_refresh(
+    response: Response,
+    user: dict = Depends(current_clinic),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0)
+):
     if not user["email_verified"]:
         return {
             "state":"unverified"
         }
     
+    # The clinic row comes from the cache, only the patients hit Postgres.
+    # One page at a time, newest first, so old history isn't resent on every
+    # login. total is the full count, so the dashboard knows there's more.
+    # Columns listed so internal ones (request_id) stay server side
+    patients = await app.state.pg.fetchrow(
+        """
+        SELECT coalesce((
+                   SELECT json_agg(p ORDER BY p.created_at DESC)
+                   FROM (
+                       SELECT id, clinic_id, name, email, phone, next_visit, reason, created_at
+                       FROM patients
+                       WHERE clinic_id = $1::uuid
+                       ORDER BY created_at DESC
+                       LIMIT $2 OFFSET $3
+                   ) p
+               ), '[]') AS data,
+               (SELECT count(*) FROM patients WHERE clinic_id = $1::uuid) AS total
+        """,
+        user["id"],
+        limit,
+        offset
+    )
 
-    new_token = create_token({"sub": email})
+    new_token = create_token({"sub": user["email"]})
     response.set_cookie(
         key="refresh_token",
         value=new_token,
@@ -323,14 +551,8 @@ def user_refresh(response: Response, refresh_token: str = Cookie(None)):
         max_age=60 * 60 * 24 * 180
     )
 
-    #Returning the patient list:-
-    patient_list = (
-        supabase_client
-        .table("patients")
-        .select("*")
-        .eq("clinic_id", user["id"])
-        .execute()
-    )
+    #Returning the patient list (same shape as a postgrest response):-
+    patient_list = {"data": patients["data"], "count": patients["total"]}
 
     return {
         "username": user["clinic_name"],
@@ -342,38 +564,24 @@ def user_refresh(response: Response, refresh_token: str = Cookie(None)):
 
 
 @app.post("/add-patient")
-def add_patient(patient_details: PatientDetails, refresh_token: str = Cookie(None)):
-    print("REFRESH TOKEN:", refresh_token)
-    if not refresh_token:
-        raise HTTPException(status_code=400, detail="No refresh token")
-
-    payload = verify_token(refresh_token)
-    if not payload:
-        raise HTTPException(status_code=400, detail="Invalid refresh token")
-
-    email = payload.get("sub")
-
-    result = (
-        supabase_client
-        .table("clinics")
-        .select("*")
-        .eq("email", email)
-        .execute()
-    )
-
-    if not result.data:
-        raise HTTPException(status_code=401, detail="User not found")
-
-    user = result.data[0]
-    clinic_id = user["id"]
+async def add_patient(patient_details: PatientDetails, email: str = Depends(current_email)):
     new_entry = {
-        "clinic_id": clinic_id,
         "name":patient_details.name,
         "email": patient_details.email,
         "phone": patient_details.phone,
         "next_visit": patient_details.next_visit,
         "reason": patient_details.reason}
-    patient_result = supabase_client.table("patients").insert(new_entry).execute()
+
+    # Clinic lookup + insert happen server side (sql/001_add_patient_for_email.sql),
+    # request_id makes a retried insert a no-op (sql/007_idempotency_keys.sql)
+    patient_result = await execute(supabase_client.rpc(
+        "add_patient_for_email",
+        {"p_email": email, "p_payload": new_entry, "p_request_id": str(uuid.uuid4())}
+    ))
+
+    if not patient_result.data:
+        raise HTTPException(status_code=401, detail="User not found")
+
     new_entry_data = patient_result.data[0]
 
     return {
@@ -383,77 +591,107 @@ def add_patient(patient_details: PatientDetails, refresh_token: str = Cookie(Non
         
     }
 @app.post("/delete-patient")
-def delete_patient(data: DeletePatient):
+async def delete_patient(data: DeletePatient):
     try:
-        deleted_patient = supabase_client.table("patients").delete().eq("id", data.patient_id).execute()
+        deleted_patient = await execute(supabase_client.table("patients").delete(returning=ReturnMethod.minimal).eq("id", data.patient_id))
         return {"message":"del-success"}
     except:
         return {"message":"del-fail"}
     
 @app.post("/logout")
-def logout(response: Response):
+async def logout(response: Response):
     response.delete_cookie("refresh_token")
     return {"ok": True}
 
 
 
 @app.post("/save-clinic-slots")
-def save_clinic_slots(
+async def save_clinic_slots(
     availability: list = Body(...),
-    refresh_token: str = Cookie(None)
+    email: str = Depends(current_email)
 ):
-    if not refresh_token:
-        raise HTTPException(status_code=401, detail="No refresh token")
-
-    payload = verify_token(refresh_token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Invalid token")
-
-    email = payload.get("sub")
-
-    supabase_client \
-        .table("clinics") \
-        .update({"clinic_slots": json.dumps(availability)}) \
-        .eq("email", email) \
-        .execute()                          
+    # Nothing comes back, not the row (and its slots) we just sent. A
+    # minimal response is an empty 204, postgrest-py reports count=0 for it
+    # whatever matched, so just drop the cached slots and let the next read
+    # refill them (and their etag) from the db.
+    await execute(
+        supabase_client
+        .table("clinics")
+        .update({"clinic_slots": availability}, returning=ReturnMethod.minimal)
+        .eq("email", email)
+    )
+    CLINIC_CACHE.pop(email, None)
+    SLOTS_CACHE.pop(email, None)
 
     return {"status": "success"}
 
-@app.post("/get-clinic-slots")
-def get_clinic_slots(refresh_token: str = Cookie(None)):
-    if not refresh_token:
-        raise HTTPException(status_code=401, detail="No refresh token")
-
-    payload = verify_token(refresh_token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Invalid token")
+async def load_clinic_slots(email: str) -> tuple:
+    # (slots, etag), from SLOTS_CACHE or read through from the db
+    cached = SLOTS_CACHE.get(email)
+    if cached is not None:
+        return cached
 
-    email = payload.get("sub")
-
-    clinic_res = (
+    clinic_res = await execute(
         supabase_client
         .table("clinics")
         .select("clinic_slots")
         .eq("email", email)
         .single()
-        .execute()                     
     )
 
     if not clinic_res.data:
         raise HTTPException(status_code=404, detail="Clinic not found")
 
+    return cache_slots(email, clinic_res.data["clinic_slots"])
+
+@app.post("/get-clinic-slots")
+async def get_clinic_slots(response: Response, email: str = Depends(current_email)):
+    slots, etag = await load_clinic_slots(email)
+    response.headers["ETag"] = etag
+
     return {
-        "clinic_slots": clinic_res.data["clinic_slots"]  # can be None
+        "clinic_slots": slots  # can be None
+    }
+
+# Conditional version for polling. 304 is only allowed for GET/HEAD, so it
+# lives here rather than on the POST
+@app.api_route("/get-clinic-slots", methods=["GET", "HEAD"])
+async def get_clinic_slots_conditional(request: Request, response: Response, email: str = Depends(current_email)):
+    slots, etag = await load_clinic_slots(email)
+
+    # Unchanged slots → 304 and no body
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    response.headers["ETag"] = etag
+
+    return {
+        "clinic_slots": slots  # can be None
     }
 @app.post("/add-appointment")
-def add_patient_appointment(appointmentSchema: PatientAppointments):
+async def add_patient_appointment(appointmentSchema: PatientAppointments):
     patient_id = appointmentSchema.patient_id
     token = generate_token()
+    request_id = str(uuid.uuid4())
     new_appointment = {
         "patient_id": patient_id,
-        "token": token
+        "token": token,
+        "request_id": request_id
     }
-    add_appointment = supabase_client.table("appointments").insert(new_appointment).execute()
+    # on_conflict request_id: a retry after a lost response won't insert twice
+    add_appointment = await execute(
+        supabase_client
+        .table("appointments")
+        .upsert(new_appointment, on_conflict="request_id", ignore_duplicates=True)
+    )
+    if not add_appointment.data:
+        add_appointment = await execute(
+            supabase_client
+            .table("appointments")
+            .select("id,token")
+            .eq("request_id", request_id)
+        )
 
     data = add_appointment.data[0]
     return {"id": data["id"],
@@ -462,280 +700,127 @@ from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 from datetime import datetime, timedelta, timezone
+import jinja2
 
+# Templates only change on deploy: don't re-stat them on every render, and
+# keep compiled bytecode on disk (default: a per-user dir under /tmp) so a
+# fresh worker skips parsing.
 templates = Jinja2Templates(directory="templates")
+templates.env.auto_reload = False
+templates.env.bytecode_cache = jinja2.FileSystemBytecodeCache()
 
 @app.get("/book/{token}", response_class=HTMLResponse)
-def book_appointment_page(request: Request, token: str):
-    # 1️⃣ Fetch appointment by token
-    appointment_res = (
-        supabase_client
-        .table("appointments")
-        .select("*")
-        .eq("token", token)
-        .single()
-        .execute()
+async def book_appointment_page(request: Request, token: str):
+    # 1️⃣ Fetch appointment, patient and clinic in one query. Tokens
+    # auto-expire after 7 days, the db compares against its own clock
+    appointment = await app.state.pg.fetchrow(
+        """
+        SELECT a.used, a.expired OR a.created_at < now() - interval '7 days' AS expired,
+               p.name AS patient_name, p.email AS patient_email, c.clinic_name
+        FROM appointments a
+        LEFT JOIN patients p ON p.id = a.patient_id
+        LEFT JOIN clinics c ON c.id = p.clinic_id
+        WHERE a.token = $1
+        """,
+        token
     )
-    if not appointment_res.data:
+    if not appointment:
         raise HTTPException(status_code=404, detail="Invalid token")
 
-    appointment = appointment_res.data
-
     # 2️⃣ Reject used or expired tokens
     if appointment["used"]:
         raise HTTPException(status_code=400, detail="Token already used")
     if appointment["expired"]:
         raise HTTPException(status_code=400, detail="Token expired")
 
-    # Optional: auto-expire after 7 days
-    created_at = datetime.fromisoformat(appointment["created_at"].replace("Z", "+00:00"))
-    now = datetime.now(timezone.utc)
-    if created_at < now - timedelta(days=7):
-        raise HTTPException(status_code=400, detail="Token expired")
-
-    # 3️⃣ Fetch patient
-    patient_res = (
-        supabase_client
-        .table("patients")
-        .select("*")
-        .eq("id", appointment["patient_id"])
-        .single()
-        .execute()
-    )
-    patient = patient_res.data
-    if not patient:
+    # 3️⃣ Patient / clinic rows gone
+    if appointment["patient_name"] is None:
         raise HTTPException(status_code=404, detail="Patient not found")
-
-    # 4️⃣ Fetch clinic
-    clinic_res = (
-        supabase_client
-        .table("clinics")
-        .select("*")
-        .eq("id", patient["clinic_id"])
-        .single()
-        .execute()
-    )
-    clinic = clinic_res.data
-    if not clinic:
+    if appointment["clinic_name"] is None:
         raise HTTPException(status_code=404, detail="Clinic not found")
 
     # 5️⃣ Compute next 7 days excluding today
-    next_7_days = [(now + timedelta(days=i)).date() for i in range(1, 8)]
+    now = datetime.now(timezone.utc)
+    next_7_days = [(now + timedelta(days=i)).date().isoformat() for i in range(1, 8)]
 
     # 6️⃣ Render template
     return templates.TemplateResponse(
         "book_appointment.html",
         {
             "request": request,
-            "patient_name": patient["name"],
-            "patient_email": patient["email"],
-            "clinic_name": clinic["clinic_name"],
+            "patient_name": appointment["patient_name"],
+            "patient_email": appointment["patient_email"],
+            "clinic_name": appointment["clinic_name"],
             "next_days": next_7_days,
             "token": token
         }
     )
 
 
-from datetime import date
-import calendar
-import json
-
-
-
-class DaySlotRequest(BaseModel):
-    token: str
-    date: date
-
 @app.post("/day-slots")
-def get_or_create_day_slots(payload: DaySlotRequest):
-    # 1. Validate appointment
-    appointment_res = (
-        supabase_client
-        .table("appointments")
-        .select("*")
-        .eq("token", payload.token)
-        .limit(1)
-        .execute()
+async def get_or_create_day_slots(payload: DaySlotRequest):
+    # Token check → clinic → existing day_slots, or build the day from the
+    # clinic's weekly slots and insert it. All server side, one round trip
+    # (sql/006_get_or_create_day_slots.sql).
+    slots = await app.state.pg.fetchval(
+        "SELECT slots FROM get_or_create_day_slots($1, $2)",
+        payload.token,
+        payload.date
     )
 
-    if not appointment_res.data:
-        raise HTTPException(status_code=404, detail="Invalid token")
-
-    appointment = appointment_res.data[0]
-
-    if appointment["used"] or appointment["expired"]:
+    # No row → unknown, used or expired token
+    if slots is None:
         raise HTTPException(status_code=400, detail="Token invalid")
 
-    # 2. Get clinic_id
-    patient_res = (
-        supabase_client
-        .table("patients")
-        .select("clinic_id")
-        .eq("id", appointment["patient_id"])
-        .limit(1)
-        .execute()
-    )
-
-    clinic_id = patient_res.data[0]["clinic_id"]
-
-    # 3. Check existing day_slots
-    existing = (
-        supabase_client
-        .table("day_slots")
-        .select("*")
-        .eq("clinic_id", clinic_id)
-        .eq("slot_date", payload.date.isoformat())
-        .limit(1)
-        .execute()
-    )
-
-    if existing.data:
-        return {
-            "date": payload.date,
-            "slots": json.loads(existing.data[0]["slots"])  # convert back to dict
-        }
-
-    # 4. Weekday (mon/tue/...)
-    weekday = calendar.day_name[payload.date.weekday()].lower()[:3]
-
-    # 5. Fetch clinic slots
-    clinic_res = (
-        supabase_client
-        .table("clinics")
-        .select("clinic_slots")
-        .eq("id", clinic_id)
-        .limit(1)
-        .execute()
-    )
-
-    clinic_slots = clinic_res.data[0]["clinic_slots"]
-
-    # convert JSON string → Python list
-    if isinstance(clinic_slots, str):
-        clinic_slots = json.loads(clinic_slots)
-
-    # 6. Build slots for the specific day
-    slots_for_day = {}
-    for day_obj in clinic_slots:
-        if weekday in day_obj:
-            for slot in day_obj[weekday]:
-                slots_for_day[slot] = "free"
-            break
-
-    # 7. Insert into day_slots (as text)
-    new_day_slot = {
-        "clinic_id": clinic_id,
-        "slot_date": payload.date.isoformat(),
-        "slots": json.dumps(slots_for_day)  # store as JSON string in text column
-    }
-
-    supabase_client.table("day_slots").insert(new_day_slot).execute()
-
     return {
         "date": payload.date,
-        "slots": slots_for_day
+        "slots": slots
     }
-@app.post("/add-slots")
-def modify_slots(details: ModifySlots):
-    # 1️⃣ Validate appointment token
-    appointment_res = (
-        supabase_client
-        .table("appointments")
-        .select("*")
-        .eq("token", details.token)
-        .single()
-        .execute()
-    )
-
-    if not appointment_res.data:
-        raise HTTPException(status_code=404, detail="Invalid token")
-
-    appointment = appointment_res.data
 
-    if appointment["used"] or appointment["expired"]:
-        raise HTTPException(status_code=400, detail="Token already used or expired")
-
-    # 2️⃣ Get patient
-    patient_res = (
-        supabase_client
-        .table("patients")
-        .select("*")
-        .eq("id", appointment["patient_id"])
-        .single()
-        .execute()
-    )
-
-    if not patient_res.data:
-        raise HTTPException(status_code=404, detail="Patient not found")
-
-    patient = patient_res.data
-    clinic_id = patient["clinic_id"]
-
-    # 3️⃣ Fetch day_slots row
-    day_slot_res = (
-        supabase_client
-        .table("day_slots")
-        .select("*")
-        .eq("clinic_id", clinic_id)
-        .eq("slot_date", details.date.isoformat())
-        .single()
-        .execute()
+@app.post("/day-slots-bulk")
+async def get_or_create_day_slots_bulk(payload: DaySlotsBulkRequest):
+    # Same as /day-slots for every date at once: one token check, one insert
+    # for the missing days, one round trip (sql/008_get_or_create_day_slots_bulk.sql)
+    rows = await app.state.pg.fetch(
+        "SELECT slot_date, slots FROM get_or_create_day_slots_bulk($1, $2)",
+        payload.token,
+        payload.dates
     )
 
-    if not day_slot_res.data:
-        raise HTTPException(status_code=404, detail="Day slots not found")
-
-    day_slot = day_slot_res.data
-
-    # 4️⃣ Parse slots JSON (TEXT → dict)
-    slots = json.loads(day_slot["slots"])
-
-    if details.slot not in slots:
-        raise HTTPException(status_code=400, detail="Slot does not exist")
-
-    if slots[details.slot] != "free":
-        raise HTTPException(status_code=400, detail="Slot already booked")
+    # No rows → unknown, used or expired token
+    if not rows:
+        raise HTTPException(status_code=400, detail="Token invalid")
 
-    # 5️⃣ Mark slot as booked
-    slots[details.slot] = "booked"
+    return {
+        "days": {row["slot_date"].isoformat(): row["slots"] for row in rows}
+    }
 
-    # 6️⃣ Update day_slots
-    supabase_client \
-        .table("day_slots") \
-        .update({
-            "slots": json.dumps(slots),
-            "updated_at": datetime.utcnow().isoformat()
-        }) \
-        .eq("id", day_slot["id"]) \
-        .execute()
-
-    # 7️⃣ Update patient next_visit
-    supabase_client \
-        .table("patients") \
-        .update({
-            "next_visit": details.date.isoformat()
-        }) \
-        .eq("id", patient["id"]) \
-        .execute()
-    
-    # 8️⃣ INSERT appointment log (🔥 THIS IS THE FIX)
-    supabase_client.table("ap_responses").insert({
-        "clinic_id": clinic_id,
-        "name": patient["name"],
-        "date": details.date.isoformat(),
-        "slot": details.slot
-    }).execute()
+# book_slot's error codes → the responses /add-slots always gave
+BOOK_SLOT_ERRORS = {
+    "invalid_token": (404, "Invalid token"),
+    "token_used": (400, "Token already used or expired"),
+    "patient_not_found": (404, "Patient not found"),
+    "day_not_found": (404, "Day slots not found"),
+    "slot_missing": (400, "Slot does not exist"),
+    "slot_booked": (400, "Slot already booked")
+}
 
-    # 8️⃣ Mark appointment token as used
-    supabase_client \
-        .table("appointments") \
-        .update({
-            "used": True
-        }) \
-        .eq("id", appointment["id"]) \
-        .execute()
-    
-    
+@app.post("/add-slots")
+async def modify_slots(details: ModifySlots):
+    # Token check, slot check-and-set, next_visit, ap_responses log and
+    # marking the token used, all in one transaction (sql/009_book_slot_by_token.sql).
+    # request_id lets a retry of a booking that went through succeed again.
+    result = await execute(supabase_client.rpc("book_slot", {
+        "p_token": details.token,
+        "p_date": details.date.isoformat(),
+        "p_slot": details.slot,
+        "p_request_id": str(uuid.uuid4())
+    }))
+
+    error = result.data.get("error")
+    if error:
+        status_code, detail = BOOK_SLOT_ERRORS[error]
+        raise HTTPException(status_code=status_code, detail=detail)
 
     return {
         "status": "success",
@@ -749,82 +834,84 @@ def modify_slots(details: ModifySlots):
 
 # ================= SCHEMA =================
 class SendEmail(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     clinic_name: str
     link: str
     patient_email: str
 
 # ================= ENDPOINT =================
-@app.post("/send-reminder-email")
-def send_reminder_email(data: SendEmail):
+async def send_reminder_task(to_email: str, subject: str, html: str):
+    # Runs after the response is sent, so failures can only be logged
     try:
-        subject = f"Appointment Reminder from {data.clinic_name}"
-
-        html = f"""
-        <p>Hi,</p>
-
-        <p>This is a reminder for your upcoming appointment at
-        <strong>{data.clinic_name}</strong>.</p>
-
-        <p>
-          Please confirm your slot by clicking below:
-        </p>
-
-        <p>
-          <a href="{data.link}">
-            Confirm Appointment
-          </a>
-        </p>
-
-        <p>— {data.clinic_name}</p>
-        """
-
-        send_email_resend(
-            to_email=data.patient_email,
+        await send_email_resend(
+            to_email=to_email,
             subject=subject,
             html=html
         )
-
-        return {"status": "success"}
-
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        print("EMAIL FAILED (reminder):", e)
 
+@app.post("/send-reminder-email")
+async def send_reminder_email(data: SendEmail, background_tasks: BackgroundTasks):
+    subject = f"Appointment Reminder from {data.clinic_name}"
 
-@app.post("/upcoming")
-def upcoming_patients(response: Response, refresh_token: str = Cookie(None)):
-    if not refresh_token:
-        raise HTTPException(status_code=400, detail="No refresh token")
+    html = f"""
+    <p>Hi,</p>
 
-    payload = verify_token(refresh_token)
-    if not payload:
-        raise HTTPException(status_code=400, detail="Invalid refresh token")
+    <p>This is a reminder for your upcoming appointment at
+    <strong>{data.clinic_name}</strong>.</p>
 
-    email = payload.get("sub")
+    <p>
+      Please confirm your slot by clicking below:
+    </p>
 
-    result = (
-        supabase_client
-        .table("clinics")
-        .select("*")
-        .eq("email", email)
-        .execute()
-    )
+    <p>
+      <a href="{data.link}">
+        Confirm Appointment
+      </a>
+    </p>
 
-    if not result.data:
-        raise HTTPException(status_code=401, detail="User not found")
+    <p>— {data.clinic_name}</p>
+    """
 
-    user = result.data[0]
+    background_tasks.add_task(send_reminder_task, data.patient_email, subject, html)
 
+    return {"status": "success"}
 
 
-    #Returning the patient list:-
-    upcoming_list = (
-        supabase_client
-        .table("ap_responses")
-        .select("*")
-        .eq("clinic_id", user["id"])
-        .execute()
+@app.post("/upcoming")
+async def upcoming_patients(
+    response: Response,
+    user: dict = Depends(current_clinic),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0)
+):
+    # Clinic row from the cache, same as /refresh. Only today onwards,
+    # soonest first, one page at a time, plus the full count
+    ap_responses = await app.state.pg.fetchrow(
+        """
+        SELECT coalesce((
+                   SELECT json_agg(r ORDER BY r.date, r.slot)
+                   FROM (
+                       SELECT id, clinic_id, name, date, slot, created_at
+                       FROM ap_responses
+                       WHERE clinic_id = $1::uuid AND date::date >= current_date
+                       ORDER BY date, slot
+                       LIMIT $2 OFFSET $3
+                   ) r
+               ), '[]') AS data,
+               (SELECT count(*) FROM ap_responses
+                WHERE clinic_id = $1::uuid AND date::date >= current_date) AS total
+        """,
+        user["id"],
+        limit,
+        offset
     )
 
+    #Returning the patient list (same shape as a postgrest response):-
+    upcoming_list = {"data": ap_responses["data"], "count": ap_responses["total"]}
+
     return {
         "username": user["clinic_name"],
         "email": user["email"],
@@ -839,33 +926,7 @@ def upcoming_patients(response: Response, refresh_token: str = Cookie(None)):
 
 
 @app.post("/user-id")
-def get_user_id(refresh_token: str = Cookie(None)):
-    print("REFRESH TOKEN:", refresh_token)
-    if not refresh_token:
-        raise HTTPException(status_code=400, detail="No refresh token")
-
-    payload = verify_token(refresh_token)
-    if not payload:
-        raise HTTPException(status_code=400, detail="Invalid refresh token")
-
-    email = payload.get("sub")
-
-    result = (
-        supabase_client
-        .table("clinics")
-        .select("*")
-        .eq("email", email)
-        .execute()
-    )
-
-    if not result.data:
-        raise HTTPException(status_code=401, detail="User not found")
-
-    user = result.data[0]
-
-
-
-
+async def get_user_id(user: dict = Depends(current_clinic)):
     return {
         "id": user["id"]        
     }
@@ -875,59 +936,58 @@ def get_product_id(form_data):
     product_id =  form_data.get("product_id")
     res = [user_id,product_id]
     return res
-@app.post("/purchase")
-async def gumroad_webhook(request: Request):
-    payload = await request.form()
-    user = None
-
-    
-    product_id = payload.get("product_id")
-
-    user_id = payload.get("url_params[user_id]")
-    if not user_id:
-        return {"message":"ignored"}
-    if product_id == '-AaBo1HcxM6kX8FHDvgSKA==':
+async def activate_clinic(ids):
+    # Runs after Gumroad already got its 200, failures can only be logged
+    user_id, product_id = ids
+    if product_id != '-AaBo1HcxM6kX8FHDvgSKA==':
+        return
 
-        result = (
+    try:
+        result = await execute(
             supabase_client
             .table("clinics")
             .update({"is_active": True})
             .eq("id", user_id)
-            .execute()
         )
-        if result.data:
-            user = result.data[0]
-            
+    except Exception as e:
+        print("ACTIVATION FAILED:", user_id, e)
+        return
 
-    
+    if result.data:
+        CLINIC_CACHE.pop(result.data[0]["email"], None)
 
+@app.post("/purchase")
+async def gumroad_webhook(request: Request, background_tasks: BackgroundTasks):
+    payload = await request.form()
 
-    print("PRODUCT ID:", product_id)
-    print("Full payload:-")
-    print(payload)
+    ids = get_product_id(payload)
+    if not ids[0]:
+        return {"message":"ignored"}
+
+    # Gumroad retries slow webhooks, answer first and update after
+    background_tasks.add_task(activate_clinic, ids)
 
-    return { "status": "ok", "updated_name": user["clinic_name"] if user else None }
+    return { "status": "ok" }
 
 
 
 @app.get("/verify-email")
-def verify_email(token: str):
-    res = (
+async def verify_email(token: str):
+    # Look up and verify in one statement, the update only matches a live token
+    res = await execute(
         supabase_client
         .table("clinics")
-        .select("*")
+        .update({
+            "email_verified": True,
+            "email_verify_token": None
+        })
         .eq("email_verify_token", token)
-        .single()
-        .execute()
     )
 
     if not res.data:
         raise HTTPException(status_code=400, detail="Invalid or expired token")
 
-    supabase_client.table("clinics").update({
-        "email_verified": True,
-        "email_verify_token": None
-    }).eq("id", res.data["id"]).execute()
+    CLINIC_CACHE.pop(res.data[0]["email"], None)
 
     return RedirectResponse(url="https://bookback.netlify.app/login.html")
 
@@ -0,0 +1,14 @@
+-- Used by /add-patient: resolves the clinic from the logged in email and
+-- inserts the patient in the same round trip.
+-- Returns no rows when the email doesn't belong to a clinic.
+create or replace function add_patient_for_email(p_email text, p_payload jsonb)
+returns setof patients
+language sql
+as $$
+    insert into patients (clinic_id, name, email, phone, next_visit, reason)
+    select c.id, r.name, r.email, r.phone, r.next_visit, r.reason
+    from clinics c,
+         jsonb_populate_record(null::patients, p_payload) r
+    where c.email = p_email
+    returning *;
+$$;
@@ -0,0 +1,7 @@
+-- clinic_slots and day_slots.slots were text holding JSON. As jsonb,
+-- postgrest returns them already parsed and they can be updated in place.
+alter table clinics
+    alter column clinic_slots type jsonb using nullif(clinic_slots, '')::jsonb;
+
+alter table day_slots
+    alter column slots type jsonb using nullif(slots, '')::jsonb;
@@ -0,0 +1,15 @@
+-- Used by /add-slots: flips one slot from "free" to "booked" only if it is
+-- still free, in a single statement. Returns a row when the slot was booked
+-- and nothing when the day, the slot, or a free slot doesn't exist.
+create or replace function book_slot(p_clinic_id uuid, p_slot_date date, p_slot text)
+returns table (booked boolean)
+language sql
+as $$
+    update day_slots
+    set slots = jsonb_set(slots, array[p_slot], '"booked"'),
+        updated_at = now()
+    where clinic_id = p_clinic_id
+      and slot_date = p_slot_date
+      and slots ->> p_slot = 'free'
+    returning true;
+$$;
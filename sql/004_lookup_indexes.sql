@@ -0,0 +1,14 @@
+-- Indexes for the equality lookups every hot endpoint makes.
+-- CONCURRENTLY can't run inside a transaction, run this file statement by
+-- statement (e.g. from the SQL editor) rather than as one batch.
+create unique index concurrently if not exists clinics_email_idx
+    on clinics (email);
+
+create unique index concurrently if not exists appointments_token_idx
+    on appointments (token);
+
+create index concurrently if not exists ap_responses_clinic_id_idx
+    on ap_responses (clinic_id);
+
+create index concurrently if not exists day_slots_clinic_date_idx
+    on day_slots (clinic_id, slot_date);
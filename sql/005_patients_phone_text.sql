@@ -0,0 +1,4 @@
+-- Phone numbers are identifiers, not numbers: a numeric column drops
+-- leading zeros and can't hold "+44 ...". /add-patient now sends a string.
+alter table patients
+    alter column phone type text using phone::text;
@@ -0,0 +1,115 @@
+-- CONCURRENTLY can't run inside a transaction, same as 004: run this file
+-- statement by statement (e.g. from the SQL editor) rather than as one batch.
+
+-- on conflict below needs a unique index, replace the plain one from 004.
+-- The old check-then-insert in /day-slots could race and create the same
+-- day twice, merge those first or the index build fails. A slot stays
+-- booked if any copy has it booked.
+update day_slots d
+set slots = merged.slots
+from (
+    select clinic_id, slot_date, jsonb_object_agg(slot, status) as slots
+    from (
+        select d.clinic_id, d.slot_date, e.key as slot,
+               case when bool_or(e.value = '"booked"'::jsonb)
+                    then '"booked"'::jsonb else '"free"'::jsonb end as status
+        from day_slots d,
+             jsonb_each(coalesce(d.slots, '{}'::jsonb)) e
+        where (d.clinic_id, d.slot_date) in (
+            select clinic_id, slot_date from day_slots
+            group by clinic_id, slot_date
+            having count(*) > 1
+        )
+        group by d.clinic_id, d.slot_date, e.key
+    ) per_slot
+    group by clinic_id, slot_date
+) merged
+where d.clinic_id = merged.clinic_id
+  and d.slot_date = merged.slot_date;
+
+delete from day_slots a
+using day_slots b
+where a.clinic_id = b.clinic_id
+  and a.slot_date = b.slot_date
+  and a.ctid > b.ctid;
+
+-- A failed CONCURRENTLY build leaves an INVALID index behind, which
+-- "if not exists" would then skip. Drop it so a re-run builds it again.
+do $$
+begin
+    if exists (
+        select 1 from pg_index i
+        join pg_class c on c.oid = i.indexrelid
+        where c.relname = 'day_slots_clinic_date_key'
+          and not i.indisvalid
+    ) then
+        drop index day_slots_clinic_date_key;
+    end if;
+end;
+$$;
+
+create unique index concurrently if not exists day_slots_clinic_date_key
+    on day_slots (clinic_id, slot_date);
+
+drop index concurrently if exists day_slots_clinic_date_idx;
+
+-- Used by /day-slots: validates the booking token and returns the day's
+-- slots, creating the day_slots row from the clinic's weekly slots the first
+-- time a date is opened. Returns no rows for an unknown, used or expired token.
+--
+-- clinic_slots looks like [{"mon": ["09:00", ...]}, {"tue": [...]}, ...];
+-- a new day gets every slot of the first entry for its weekday as "free".
+create or replace function get_or_create_day_slots(p_token text, p_date date)
+returns table (slots jsonb)
+language plpgsql
+as $$
+declare
+    v_clinic_id uuid;
+    v_clinic_slots jsonb;
+    v_weekday text := to_char(p_date, 'dy');
+    v_slots jsonb;
+begin
+    select p.clinic_id, c.clinic_slots
+    into v_clinic_id, v_clinic_slots
+    from appointments a
+    join patients p on p.id = a.patient_id
+    join clinics c on c.id = p.clinic_id
+    where a.token = p_token
+      and not a.used
+      and not a.expired;
+
+    if not found then
+        return;
+    end if;
+
+    select d.slots into v_slots
+    from day_slots d
+    where d.clinic_id = v_clinic_id and d.slot_date = p_date;
+
+    if found then
+        return query select v_slots;
+        return;
+    end if;
+
+    select coalesce(jsonb_object_agg(slot, '"free"'::jsonb), '{}'::jsonb)
+    into v_slots
+    from (
+        select day_obj -> v_weekday as day_list
+        from jsonb_array_elements(coalesce(v_clinic_slots, '[]'::jsonb))
+             with ordinality as week(day_obj, n)
+        where day_obj ? v_weekday
+        order by n
+        limit 1
+    ) first_day,
+    jsonb_array_elements_text(first_day.day_list) as slot;
+
+    insert into day_slots (clinic_id, slot_date, slots)
+    values (v_clinic_id, p_date, v_slots)
+    on conflict (clinic_id, slot_date) do nothing;
+
+    -- Another request may have created the day first, return what's stored
+    return query
+        select d.slots from day_slots d
+        where d.clinic_id = v_clinic_id and d.slot_date = p_date;
+end;
+$$;
@@ -0,0 +1,30 @@
+-- Idempotency keys for the inserts the backend may retry. Each request
+-- sends a fresh uuid, a retried insert then hits the unique index and
+-- becomes a no-op instead of a duplicate row.
+alter table appointments add column if not exists request_id uuid;
+alter table patients add column if not exists request_id uuid;
+alter table ap_responses add column if not exists request_id uuid;
+
+create unique index if not exists appointments_request_id_key on appointments (request_id);
+create unique index if not exists patients_request_id_key on patients (request_id);
+create unique index if not exists ap_responses_request_id_key on ap_responses (request_id);
+
+-- add_patient_for_email gains the key, drop the old two-argument version.
+drop function if exists add_patient_for_email(text, jsonb);
+
+create or replace function add_patient_for_email(p_email text, p_payload jsonb, p_request_id uuid)
+returns setof patients
+language plpgsql
+as $$
+begin
+    insert into patients (clinic_id, name, email, phone, next_visit, reason, request_id)
+    select c.id, r.name, r.email, r.phone, r.next_visit, r.reason, p_request_id
+    from clinics c,
+         jsonb_populate_record(null::patients, p_payload) r
+    where c.email = p_email
+    on conflict (request_id) do nothing;
+
+    -- The row from this call, or from an earlier attempt of the same request
+    return query select * from patients where request_id = p_request_id;
+end;
+$$;
@@ -0,0 +1,55 @@
+-- Used by /day-slots-bulk: get_or_create_day_slots for several dates at
+-- once, so the booking page can load a whole week in one round trip.
+-- Validates the token once, creates every missing day in a single insert
+-- and returns one (slot_date, slots) row per requested date.
+-- Returns no rows for an unknown, used or expired token.
+create or replace function get_or_create_day_slots_bulk(p_token text, p_dates date[])
+returns table (slot_date date, slots jsonb)
+language plpgsql
+as $$
+#variable_conflict use_column
+declare
+    v_clinic_id uuid;
+    v_clinic_slots jsonb;
+begin
+    select p.clinic_id, c.clinic_slots
+    into v_clinic_id, v_clinic_slots
+    from appointments a
+    join patients p on p.id = a.patient_id
+    join clinics c on c.id = p.clinic_id
+    where a.token = p_token
+      and not a.used
+      and not a.expired;
+
+    if not found then
+        return;
+    end if;
+
+    -- Same default as get_or_create_day_slots: every slot of the first
+    -- clinic_slots entry for the weekday, as "free"
+    insert into day_slots (clinic_id, slot_date, slots)
+    select v_clinic_id, missing.day, coalesce((
+        select jsonb_object_agg(slot, '"free"'::jsonb)
+        from (
+            select day_obj -> to_char(missing.day, 'dy') as day_list
+            from jsonb_array_elements(coalesce(v_clinic_slots, '[]'::jsonb))
+                 with ordinality as week(day_obj, n)
+            where day_obj ? to_char(missing.day, 'dy')
+            order by n
+            limit 1
+        ) first_day,
+        jsonb_array_elements_text(first_day.day_list) as slot
+    ), '{}'::jsonb)
+    from (select distinct unnest(p_dates) as day) missing
+    where not exists (
+        select 1 from day_slots d
+        where d.clinic_id = v_clinic_id and d.slot_date = missing.day
+    )
+    on conflict (clinic_id, slot_date) do nothing;
+
+    return query
+        select d.slot_date, d.slots from day_slots d
+        where d.clinic_id = v_clinic_id and d.slot_date = any(p_dates)
+        order by d.slot_date;
+end;
+$$;
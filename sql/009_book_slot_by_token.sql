@@ -0,0 +1,86 @@
+-- Used by /add-slots: the whole booking in one transaction. Replaces the
+-- slot-only book_slot from 003, the token check, next_visit update,
+-- ap_responses insert and marking the token used now happen here too.
+--
+-- Returns {"status": "booked"} or {"error": ...} with one of
+-- invalid_token, token_used, patient_not_found, day_not_found,
+-- slot_missing, slot_booked.
+-- p_request_id makes a retry of a booking that already went through
+-- return "booked" again instead of token_used.
+drop function if exists book_slot(uuid, date, text);
+
+create or replace function book_slot(p_token text, p_date date, p_slot text, p_request_id uuid)
+returns json
+language plpgsql
+as $$
+declare
+    v_appointment_id uuid;
+    v_used boolean;
+    v_expired boolean;
+    v_patient_id uuid;
+    v_clinic_id uuid;
+    v_name text;
+    v_slots jsonb;
+begin
+    -- Lock the appointment so the same token can't book twice at once
+    select a.id, a.used, a.expired, p.id, p.clinic_id, p.name
+    into v_appointment_id, v_used, v_expired, v_patient_id, v_clinic_id, v_name
+    from appointments a
+    left join patients p on p.id = a.patient_id
+    where a.token = p_token
+    for update of a;
+
+    if not found then
+        return json_build_object('error', 'invalid_token');
+    end if;
+
+    -- Replay check only once we hold the lock: a retry that overlapped the
+    -- first attempt waits above, then sees its committed log row here
+    -- instead of reading the token as used
+    if exists (select 1 from ap_responses where request_id = p_request_id) then
+        return json_build_object('status', 'booked');
+    end if;
+
+    if v_used or v_expired then
+        return json_build_object('error', 'token_used');
+    end if;
+
+    if v_patient_id is null then
+        return json_build_object('error', 'patient_not_found');
+    end if;
+
+    -- Check-and-set, two bookings racing for the same slot can't both win
+    update day_slots
+    set slots = jsonb_set(slots, array[p_slot], '"booked"'),
+        updated_at = now()
+    where clinic_id = v_clinic_id
+      and slot_date = p_date
+      and slots ->> p_slot = 'free';
+
+    if not found then
+        -- Nothing flipped, say why
+        select d.slots into v_slots
+        from day_slots d
+        where d.clinic_id = v_clinic_id and d.slot_date = p_date;
+
+        if not found then
+            return json_build_object('error', 'day_not_found');
+        end if;
+
+        if not coalesce(v_slots ? p_slot, false) then
+            return json_build_object('error', 'slot_missing');
+        end if;
+
+        return json_build_object('error', 'slot_booked');
+    end if;
+
+    update patients set next_visit = p_date where id = v_patient_id;
+
+    insert into ap_responses (clinic_id, name, date, slot, request_id)
+    values (v_clinic_id, v_name, p_date, p_slot, p_request_id);
+
+    update appointments set used = true where id = v_appointment_id;
+
+    return json_build_object('status', 'booked');
+end;
+$$;
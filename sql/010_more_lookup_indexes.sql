@@ -0,0 +1,20 @@
+-- More of the equality lookups from the hot paths. Same as 004: run
+-- statement by statement, CONCURRENTLY can't run inside a transaction.
+
+-- /verify-email filters on the token; only unverified rows carry one.
+create unique index concurrently if not exists clinics_email_verify_token_key
+    on clinics (email_verify_token)
+    where email_verify_token is not null;
+
+-- /refresh lists a clinic's patients.
+create index concurrently if not exists patients_clinic_id_idx
+    on patients (clinic_id);
+
+-- The clinic-by-email lookup (get_clinic_by_email) reads only these columns,
+-- so it can be answered from the index alone. Still unique, it takes over
+-- from 004's plain index, including as the /signup on_conflict target.
+create unique index concurrently if not exists clinics_email_covering_key
+    on clinics (email)
+    include (id, clinic_name, is_active, email_verified);
+
+drop index concurrently if exists clinics_email_idx;
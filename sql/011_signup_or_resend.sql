@@ -0,0 +1,35 @@
+-- Used by /signup: creates the clinic, or gives an existing unverified one
+-- a fresh verify token, in one call. Returns the row with created = true
+-- for a new clinic and false for a resend. Returns no rows when the email
+-- is already verified.
+create or replace function signup_or_resend(p_email text, p_hash text, p_name text, p_token text)
+returns table (email text, clinic_name text, created boolean)
+language plpgsql
+as $$
+#variable_conflict use_column
+begin
+    return query
+        with inserted as (
+            insert into clinics (email, clinic_name, password_hash, email_verified, email_verify_token)
+            values (p_email, p_name, p_hash, false, p_token)
+            on conflict (email) do nothing
+            returning clinics.email, clinics.clinic_name
+        )
+        select i.email, i.clinic_name, true from inserted i;
+
+    if found then
+        return;
+    end if;
+
+    -- Verified rows don't match, they get nothing back
+    return query
+        with updated as (
+            update clinics
+            set email_verify_token = p_token
+            where clinics.email = p_email
+              and not clinics.email_verified
+            returning clinics.email, clinics.clinic_name
+        )
+        select u.email, u.clinic_name, false from updated u;
+end;
+$$;
@@ -0,0 +1,39 @@
+-- Verify tokens come from Postgres (gen_random_uuid is a CSPRNG), the app
+-- no longer sends one. signup_or_resend drops p_token and returns the
+-- token it stored.
+alter table clinics
+    alter column email_verify_token set default gen_random_uuid()::text;
+
+drop function if exists signup_or_resend(text, text, text, text);
+
+create or replace function signup_or_resend(p_email text, p_hash text, p_name text)
+returns table (email text, clinic_name text, email_verify_token text, created boolean)
+language plpgsql
+as $$
+#variable_conflict use_column
+begin
+    return query
+        with inserted as (
+            insert into clinics (email, clinic_name, password_hash, email_verified)
+            values (p_email, p_name, p_hash, false)
+            on conflict (email) do nothing
+            returning clinics.email, clinics.clinic_name, clinics.email_verify_token
+        )
+        select i.email, i.clinic_name, i.email_verify_token, true from inserted i;
+
+    if found then
+        return;
+    end if;
+
+    -- Verified rows don't match, they get nothing back
+    return query
+        with updated as (
+            update clinics
+            set email_verify_token = default
+            where clinics.email = p_email
+              and not clinics.email_verified
+            returning clinics.email, clinics.clinic_name, clinics.email_verify_token
+        )
+        select u.email, u.clinic_name, u.email_verify_token, false from updated u;
+end;
+$$;